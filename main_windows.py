@@ -8,41 +8,29 @@ text and hex-encoded watermarks embedded in the PDF structure.
 The red header at the top is in plain text and can easily be striped
 out. The large watermark is hex-encoded and needs a more subtle
 approach, but identifying the strings initially was the most work.
-After identifying them we can easily strip them out with regex and an
-uncompressed version of the PDF.
+After identifying them we can easily strip them out once the page
+content streams are decompressed.
 
 Usage:
     python main_windows.py input.pdf output.pdf
 
 Process Overview:
-    1. UNCOMPRESS - Use pdftk to uncompress the PDF structure
-       - Makes the PDF content stream readable as plain text
-       - Required for text manipulation in step 2
-       - Example: Binary PDF → Uncompressed text-readable PDF
+    1. DECOMPRESS CONTENT STREAMS - Use pikepdf to read each page
+       - Opens the PDF in-process, no external tools or temp files
+       - Covers page contents and the Form XObjects they draw
+       - stream.read_bytes() applies the stream filters (FlateDecode)
+       - Makes the page content readable as plain PDF operators
+       - Example: Compressed stream → Decoded content stream bytes
 
     2. REMOVE TEXT HEADERS - Use Python to strip plain text watermarks
        - Removes visible text strings like "For personal,"
        - Removes "non-commercial use only." and Dow Jones reprint info
-       - These appear as literal strings in the uncompressed PDF content
+       - These appear as literal strings in the decoded content stream
        - Example: "For personal," → (removed)
 
-    3. RE-COMPRESS - Use pdftk to compress the PDF back
-       - Re-creates a valid PDF structure after text manipulation
-       - Required because text changes may leave the PDF in an invalid state
-       - Ensures qpdf can properly parse the PDF in step 4
-       - Example: Modified uncompressed PDF → Valid compressed PDF
-
-    4. UNPACK PDF STRUCTURE - Use qpdf to expand PDF objects
-       - Converts compressed object streams to individual objects
-       - Makes hex-encoded watermarks accessible for pattern matching
-       - The --qdf flag creates a normalized "Quality PDF" structure
-       - The --object-streams=disable flag expands all compressed streams
-       - Required for reliable regex matching in step 5
-       - Example: Compressed objects → Expanded individual objects
-
-    5. REMOVE HEX WATERMARKS - Use pikepdf to strip encoded watermarks
-       - Scans PDF content streams for hex-encoded text commands
-       - Removes PDF graphics commands that draw watermark text
+    3. REMOVE HEX WATERMARKS - Strip encoded watermarks with pikepdf
+       - Parses the same decoded stream into PDF operators
+       - Drops the q ... Q block whose Tj draws a watermark string
        - Watermarks are UTF-16BE encoded and embedded in PDF drawing ops
        - Pattern: q 0.000 0.000 0.502 rg BT <HEX> Tj ET Q
          * q = Save graphics state
@@ -54,26 +42,27 @@ Process Overview:
          * Q = Restore graphics state
        - Example: q ... <0046...> ... Tj ET Q → (removed)
 
+    4. SAVE - Write the cleaned PDF once with pikepdf
+       - Modified streams are recompressed on save
+       - Small objects are packed into compressed object streams
+       - Example: Cleaned document → output.pdf
+
 Dependencies:
-    Windows versions required:
-    - PDFtk Server: https://www.pdflabs.com/tools/pdftk-server/
-      Install and add to PATH
-    - QPDF: https://github.com/qpdf/qpdf/releases
-      Install and add to PATH
     - pikepdf: pip install pikepdf
 
 Installation:
-    1. Install PDFtk Server for Windows
-    2. Install QPDF for Windows
-    3. Add both to your system PATH
-    4. pip install pikepdf
+    1. pip install pikepdf
 """
 
+import os
 import re
-import subprocess
+import shutil
 import sys
+import tempfile
+import zlib
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
-from tempfile import TemporaryDirectory
 
 import pikepdf
 
@@ -83,6 +72,38 @@ HEX_FOR = b"<0046006f007200200070006500720073006f006e0061006c002c>"
 # Hex-encoded " non-commercial use only." (UTF-16BE: 0x0020=' ', 0x006e='n', ...)
 HEX_NONCOMM = b"<0020006e006f006e002d0063006f006d006d00650072006300690061006c00200075007300650020006f006e006c0079002e>"
 
+# Either watermark hex string in any letter case, allowing the
+# whitespace PDF permits between hex digits; picks the streams to parse
+WATERMARK_HEX = re.compile(
+    rb"<\s*(?:"
+    + rb"\s*".join(bytes([digit]) for digit in HEX_FOR[1:-1])
+    + rb"|"
+    + rb"\s*".join(bytes([digit]) for digit in HEX_NONCOMM[1:-1])
+    + rb")\s*>",
+    re.IGNORECASE,
+)
+
+# Decoded watermark strings, as they appear in a parsed Tj operand
+WATERMARK_STRINGS = (
+    bytes.fromhex(HEX_FOR[1:-1].decode()),
+    bytes.fromhex(HEX_NONCOMM[1:-1].decode()),
+)
+
+# Fill colour of the watermark text (dark blue), and the operators that
+# change the fill colour
+WATERMARK_RGB = (0.0, 0.0, 0.502)
+FILL_COLOUR_OPERATORS = frozenset("rg g k sc scn cs".split())
+
+# Operators that show text inside a BT ... ET object
+TEXT_SHOWING_OPERATORS = frozenset(["Tj", "TJ", "'", '"'])
+
+# Operators that may sit next to the watermark text object inside its
+# own q ... Q block: colour, graphics state, position and text state
+WATERMARK_STATE_OPERATORS = frozenset(
+    "rg RG g G k K cs CS sc SC scn SCN gs cm "
+    "Tf Tc Tw Tz TL Tr Ts Td TD Tm T*".split()
+)
+
 # Text patterns to remove from PDF (as bytes for binary mode)
 TEXT_PATTERNS = [
     b"For personal,",
@@ -91,50 +112,206 @@ TEXT_PATTERNS = [
     b"www.djreprints.com",
 ]
 
+# Edited streams are new bytes in full (unparse_content_stream rewrites
+# the whole stream), so large ones are deflated at level 1 here rather
+# than at the default level on save
+LARGE_STREAM_BYTES = 1_000_000
+
+# Starting worker processes costs ~130 ms with spawn, while a stream
+# that needs parsing takes ~20 ms and the rest well under 1 ms, so the
+# pool only pays off on larger documents. Streams are then decoded and
+# sent to the workers one batch at a time.
+PARALLEL_MIN_STREAMS = 32
+PARALLEL_BATCH_STREAMS = 32
+
+# Image codecs never wrap content operators, and read_bytes() can't
+# decode most of them, so streams using these filters are skipped
+IMAGE_FILTERS = (
+    pikepdf.Name.DCTDecode,
+    pikepdf.Name.JPXDecode,
+    pikepdf.Name.CCITTFaxDecode,
+    pikepdf.Name.JBIG2Decode,
+)
+
+
+def is_image_stream(stream: pikepdf.Stream) -> bool:
+    """
+    Checks whether a page content stream is encoded with an image
+    filter, as happens when a scanned page is stored as its content.
 
-def strip_watermark(stream_bytes: bytes) -> bytes:
+    Args:
+        stream: A page content stream
+
+    Returns:
+        True if any of the stream's filters is an image codec
     """
-    Scans the PDF content stream for watermark drawing commands and
-    removes them. Watermarks appear as PDF graphics state operations
-    that draw text in a specific color (dark blue: RGB 0, 0, 0.502)
-    with hex-encoded strings.
+    filters = stream.get(pikepdf.Name.Filter)
+    if filters is None:
+        return False
+    if not isinstance(filters, pikepdf.Array):
+        filters = [filters]
+    return any(f in IMAGE_FILTERS for f in filters)
+
+
+def is_watermark_fill(operands) -> bool:
+    """
+    Checks whether the operands of an rg operator set the watermark's
+    dark blue fill colour, however the producer formats the numbers.
 
     Args:
-        stream_bytes: Raw bytes from a PDF content stream
+        operands: Operands of a parsed rg instruction
 
     Returns:
-        Cleaned stream bytes with watermark commands removed
+        True if the colour is RGB 0, 0, 0.502
     """
-    # Remove "For personal," watermark block
-    stream_bytes = re.sub(
-        rb"q\s+0\.000\s+0\.000\s+0\.502\s+rg\s+BT.*?"
-        + re.escape(HEX_FOR)
-        + rb".*?Tj\s+ET\s+Q\s*\r?\n",
-        b"",
-        stream_bytes,
+    try:
+        values = [float(value) for value in operands]
+    except (TypeError, ValueError):
+        return False
+    return len(values) == 3 and all(
+        abs(value - target) < 0.001
+        for value, target in zip(values, WATERMARK_RGB)
     )
 
-    # Remove " non-commercial use only." watermark block
-    stream_bytes = re.sub(
-        rb"q\s+0\.000\s+0\.000\s+0\.502\s+rg\s+BT.*?"
-        + re.escape(HEX_NONCOMM)
-        + rb".*?Tj\s+ET\s+Q\s*\r?\n",
-        b"",
-        stream_bytes,
-    )
 
-    return stream_bytes
+def strip_watermark(stream_bytes: bytes) -> bytes:
+    """
+    Parses the PDF content stream into operators and drops the Tj
+    operators that show watermark text in the watermark fill colour.
+    A text object (BT ... ET) showing nothing else is dropped whole,
+    together with its q ... Q block when that block holds nothing else.
+    Watermarks appear as PDF graphics state operations that draw text
+    in a specific color (dark blue: RGB 0, 0, 0.502) with hex-encoded
+    strings. The plain text headers are removed from the same buffer
+    first, so each stream is cleaned in one call.
+
+    Args:
+        stream_bytes: Decoded bytes from a PDF content stream
+
+    Returns:
+        Cleaned stream bytes with headers and watermark commands removed
+    """
+    stream_bytes = remove_text_patterns(stream_bytes)
+
+    # Most streams carry no watermark; a regex search is far cheaper
+    # than parsing them
+    if not WATERMARK_HEX.search(stream_bytes):
+        return stream_bytes
+
+    # Only bytes reach the worker processes, so parse them through a
+    # scratch document rather than the source PDF
+    with pikepdf.new() as scratch:
+        instructions = pikepdf.parse_content_stream(
+            pikepdf.Stream(scratch, stream_bytes)
+        )
+
+        # One list of instructions per open q, outermost first. For each
+        # block, track whether it drew a watermark, whether it holds
+        # anything besides graphics state and the watermark text object,
+        # and whether the current fill colour is the watermark's blue
+        blocks = [[]]
+        has_watermark = [False]
+        has_other = [False]
+        watermark_fill = [False]
+        text_object = None
+        text_shows = 0
+        watermark_shows = []
+        dropped = False
+
+        for instruction in instructions:
+            operator = str(instruction.operator)
+
+            if operator in FILL_COLOUR_OPERATORS:
+                watermark_fill[-1] = operator == "rg" and is_watermark_fill(
+                    instruction.operands
+                )
+
+            # Buffer each BT ... ET so watermark text can be dropped
+            # without touching the rest of its block
+            if text_object is not None:
+                if operator in TEXT_SHOWING_OPERATORS:
+                    text_shows += 1
+                    operands = instruction.operands
+                    if (
+                        operator == "Tj"
+                        and watermark_fill[-1]
+                        and operands
+                        and isinstance(operands[0], pikepdf.String)
+                        and bytes(operands[0]) in WATERMARK_STRINGS
+                    ):
+                        watermark_shows.append(len(text_object))
+                text_object.append(instruction)
+
+                if operator == "ET":
+                    if not watermark_shows:
+                        blocks[-1].extend(text_object)
+                        has_other[-1] = True
+                    elif len(watermark_shows) == text_shows:
+                        # Nothing but watermark text: drop the object
+                        has_watermark[-1] = True
+                        dropped = True
+                    else:
+                        # Mixed with real text: drop only the watermark Tj
+                        blocks[-1].extend(
+                            text_instruction
+                            for index, text_instruction in enumerate(
+                                text_object
+                            )
+                            if index not in watermark_shows
+                        )
+                        has_other[-1] = True
+                        dropped = True
+                    text_object = None
+                continue
+
+            if operator == "BT":
+                text_object = [instruction]
+                text_shows = 0
+                watermark_shows = []
+            elif operator == "q":
+                blocks.append([instruction])
+                has_watermark.append(False)
+                has_other.append(False)
+                watermark_fill.append(watermark_fill[-1])
+            elif operator == "Q" and len(blocks) > 1:
+                block = blocks.pop()
+                block.append(instruction)
+                block_has_watermark = has_watermark.pop()
+                block_has_other = has_other.pop()
+                watermark_fill.pop()
+
+                # A block that only set up and drew the watermark goes
+                # entirely; otherwise only its watermark text was removed
+                if block_has_watermark and not block_has_other:
+                    has_watermark[-1] = True
+                    continue
+                blocks[-1].extend(block)
+                has_other[-1] = True
+            else:
+                blocks[-1].append(instruction)
+                if operator not in WATERMARK_STATE_OPERATORS:
+                    has_other[-1] = True
+
+        if not dropped:
+            return stream_bytes
+
+        # Keep any BT or q left open at the end of the stream
+        if text_object is not None:
+            blocks[-1].extend(text_object)
+        for block in blocks[1:]:
+            blocks[0].extend(block)
+
+        return pikepdf.unparse_content_stream(blocks[0])
 
 
 def remove_text_patterns(content: bytes) -> bytes:
     """
     Remove text watermark patterns from PDF content.
 
-    This replaces sed on Linux/Mac since Windows doesn't have sed by default.
     Works on binary data to avoid corrupting the PDF structure.
 
     Args:
-        content: PDF content as bytes
+        content: Decoded bytes from a PDF content stream
 
     Returns:
         Content with text patterns removed
@@ -144,131 +321,167 @@ def remove_text_patterns(content: bytes) -> bytes:
     return content
 
 
+def collect_content_streams(pdf: pikepdf.Pdf) -> list:
+    """
+    Gathers every page content stream plus every Form XObject reachable
+    from the pages' resources, including forms nested in other forms.
+    Headers can be drawn inside a form as well as on the page itself.
+    Streams shared between pages are returned once.
+
+    Args:
+        pdf: The open PDF document
+
+    Returns:
+        List of content streams to clean, without image-encoded ones
+    """
+    streams = []
+    seen = set()
+    resources = []
+
+    def add(stream):
+        if stream.objgen in seen:
+            return False
+        seen.add(stream.objgen)
+        if not is_image_stream(stream):
+            streams.append(stream)
+        return True
+
+    for page in pdf.pages:
+        contents = page.obj.get(pikepdf.Name.Contents)
+        if contents:
+            for stream in (
+                contents if isinstance(contents, pikepdf.Array) else [contents]
+            ):
+                add(stream)
+        resources.append(page.obj.get(pikepdf.Name.Resources))
+
+    while resources:
+        current = resources.pop()
+        if current is None:
+            continue
+        xobjects = current.get(pikepdf.Name.XObject)
+        if xobjects is None:
+            continue
+
+        for xobject in xobjects.values():
+            if (
+                isinstance(xobject, pikepdf.Stream)
+                and xobject.get(pikepdf.Name.Subtype) == pikepdf.Name.Form
+                and add(xobject)
+            ):
+                resources.append(xobject.get(pikepdf.Name.Resources))
+
+    return streams
+
+
+def clean_streams(streams: list, executor: Executor | None = None):
+    """
+    Decodes each content stream and runs strip_watermark on it, in the
+    current process or on the given executor. With an executor, streams
+    are decoded in batches so only one batch of bytes is held and
+    pickled at a time.
+
+    Args:
+        streams: Content streams to clean
+        executor: Optional process pool to run strip_watermark on
+
+    Yields:
+        (stream, data, cleaned) for each stream, in order
+    """
+    if executor is None:
+        for stream in streams:
+            data = stream.read_bytes()
+            yield stream, data, strip_watermark(data)
+        return
+
+    # pikepdf objects can't be pickled, so only the decoded bytes are
+    # sent to the worker processes; writes happen in the caller
+    for start in range(0, len(streams), PARALLEL_BATCH_STREAMS):
+        batch = streams[start : start + PARALLEL_BATCH_STREAMS]
+        originals = [stream.read_bytes() for stream in batch]
+        yield from zip(
+            batch, originals, executor.map(strip_watermark, originals)
+        )
+
+
 def process_pdf(input_path: Path, output_path: Path):
     """
-    This is the main processing pipeline that orchestrates the
-    five-step cleaning process. All intermediate files are stored in a
-    temporary directory that is automatically cleaned up when
-    processing completes.
+    This is the main processing pipeline. The PDF is opened once with
+    pikepdf, every page content stream and Form XObject is decoded,
+    cleaned of headers and watermarks, and the document is saved once
+    to output_path.
+    Pages are independent, so on larger documents watermark stripping
+    runs across a pool of worker processes.
 
     Args:
         input_path: Path to the input WSJ PDF with watermarks
         output_path: Path where the cleaned PDF should be saved
 
     Raises:
-        subprocess.CalledProcessError: If pdftk or qpdf commands fail
         pikepdf.PdfError: If PDF structure is invalid or unreadable
-        FileNotFoundError: If input_path doesn't exist or tools not in PATH
+        FileNotFoundError: If input_path doesn't exist
     """
 
-    with TemporaryDirectory() as work_dir:
-        work_dir = Path(work_dir)
+    # pikepdf can't save over the file it has open, so an in-place run
+    # saves next to it and replaces the input once it has been closed
+    in_place = output_path.exists() and output_path.samefile(input_path)
+    save_path = output_path
+
+    print(f"Processing: {input_path.name}")
+    # Memory-map the input so qpdf reads the (often tens of MB) file
+    # through the page cache instead of buffered file reads
+    with pikepdf.open(input_path, access_mode=pikepdf.AccessMode.mmap) as pdf:
+        streams = collect_content_streams(pdf)
+        use_pool = (
+            len(streams) >= PARALLEL_MIN_STREAMS and (os.cpu_count() or 1) > 1
+        )
+        with ProcessPoolExecutor() if use_pool else nullcontext() as executor:
+            pages_modified = 0
+            for stream, data, cleaned in clean_streams(streams, executor):
+                if cleaned == data:
+                    continue
 
-        # Step 1: Uncompress PDF
-        print(f"[1/5] Uncompressing: {input_path.name}")
-        uncompressed = work_dir / "uncompressed.pdf"
-        try:
-            subprocess.run(
-                [
-                    "pdftk",
-                    str(input_path),
-                    "output",
-                    str(uncompressed),
-                    "uncompress",
-                ],
-                check=True,
-                capture_output=True,
-                text=True,
+                if len(cleaned) > LARGE_STREAM_BYTES:
+                    stream.write(
+                        zlib.compress(cleaned, 1),
+                        filter=pikepdf.Name.FlateDecode,
+                    )
+                else:
+                    stream.write(cleaned)
+                pages_modified += 1
+
+        # Nothing to remove: copy the input instead of re-serializing it,
+        # or leave it alone when it is also the output
+        if not pages_modified:
+            if not in_place:
+                shutil.copyfile(input_path, output_path)
+            print(f"Complete: {output_path.name} (no watermarks found)")
+            return
+
+        if in_place:
+            fd, temp_name = tempfile.mkstemp(
+                suffix=".pdf", dir=output_path.parent
             )
-        except FileNotFoundError:
-            print(
-                "Error: pdftk not found. Please install PDFtk Server and add to PATH."
-            )
-            print("Download: https://www.pdflabs.com/tools/pdftk-server/")
-            raise
-
-        # Step 2: Remove text headers with Python (instead of sed)
-        print("[2/5] Removing text headers...")
-        tmp_pdf = work_dir / "tmp.pdf"
-
-        # Read the uncompressed PDF as BINARY (critical to avoid corruption)
-        with open(uncompressed, "rb") as f_in:
-            content = f_in.read()
-
-        # Remove text patterns (working on bytes)
-        content = remove_text_patterns(content)
-
-        # Write the modified content as BINARY
-        with open(tmp_pdf, "wb") as f_out:
-            f_out.write(content)
-
-        # Step 3: Re-compress PDF (required for qpdf to work properly)
-        print("[3/5] Re-compressing PDF...")
-        no_header = work_dir / "no_header.pdf"
-        subprocess.run(
-            [
-                "pdftk",
-                str(tmp_pdf),
-                "output",
-                str(no_header),
-                "compress",
-            ],
-            check=True,
-            capture_output=True,
-            text=True,
-        )
+            os.close(fd)
+            save_path = Path(temp_name)
 
-        # Step 4: Unpack PDF for watermark removal
-        print("[4/5] Unpacking PDF structure...")
-        unpacked = work_dir / "unpacked.pdf"
         try:
-            subprocess.run(
-                [
-                    "qpdf",
-                    "--qdf",
-                    "--object-streams=disable",
-                    str(no_header),
-                    str(unpacked),
-                ],
-                check=True,
-                capture_output=True,
-                text=True,
+            pdf.save(
+                save_path,
+                compress_streams=True,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
             )
-        except FileNotFoundError:
-            print(
-                "Error: qpdf not found. Please install QPDF and add to PATH."
-            )
-            print("Download: https://github.com/qpdf/qpdf/releases")
+        except Exception:
+            if in_place:
+                save_path.unlink(missing_ok=True)
             raise
 
-        # Step 5: Remove hex-encoded watermarks
-        print("[5/5] Removing hex watermarks...")
-        with pikepdf.open(unpacked) as pdf:
-            pages_modified = 0
-
-            for page in pdf.pages:
-                contents = page.Contents
-                if not contents:
-                    continue
-
-                streams = (
-                    contents
-                    if isinstance(contents, pikepdf.Array)
-                    else [contents]
-                )
+    if in_place:
+        # mkstemp creates the file owner-only; keep the input's mode
+        shutil.copymode(output_path, save_path)
+        os.replace(save_path, output_path)
 
-                for stream in streams:
-                    data = stream.read_bytes()
-                    cleaned = strip_watermark(data)
-                    if cleaned != data:
-                        stream.write(cleaned)
-                        pages_modified += 1
-
-            pdf.save(output_path)
-
-        print(
-            f"Complete: {output_path.name} ({pages_modified} pages modified)"
-        )
+    print(f"Complete: {output_path.name} ({pages_modified} pages modified)")
 
 
 def main():
@@ -293,10 +506,6 @@ def main():
 
     try:
         process_pdf(input_path, output_path)
-    except FileNotFoundError as e:
-        print("Error: Required tool not found in PATH")
-        print(f"Details: {e}")
-        sys.exit(1)
     except Exception as e:
         print(f"Error: {e}")
         sys.exit(1)